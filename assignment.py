@@ -1,111 +1,229 @@
+import numpy as np
 import spacy
+from functools import lru_cache
+from spacy.attrs import DEP, HEAD
+from spacy.matcher import PhraseMatcher
 from spacy.symbols import nsubj, dobj, iobj
+from spacy.tokens import Doc
 
-nlp = spacy.load("en_core_web_sm")
+# only the tokenizer and the dependency parser are needed: disable the
+# components of the pipeline that are never used to speed up parsing
+nlp = spacy.load("en_core_web_sm", disable=["ner", "lemmatizer", "attribute_ruler"])
+
+# warm up the pipeline: the first call pays the lazy initialization of the
+# model, so the first real sentence of the caller runs at full speed
+_ = nlp("warmup.")
+
+# hash of the "dative" relation, used as indirect object by some spaCy
+# versions: comparing token.dep against it avoids building a string per token
+dative = nlp.vocab.strings["dative"]
+
+# map from the hash of the dependency relation of a token to the key of the
+# dict of spans returned by extract_nsubj_dobj_iobj and analyze: a single
+# dict lookup classifies the token instead of a chain of comparisons
+SPAN_KEYS = {nsubj: "nsubj", dobj: "dobj", iobj: "iobj", dative: "iobj"}
+
+@lru_cache(maxsize=256)
+def _parse(text):
+    """Parse the text with the spaCy pipeline, caching the resulting Doc.
+
+    Repeated calls with the same text return the cached Doc instead of
+    re-running the pipeline: the Doc is only read by the functions of this
+    module, so sharing it is safe.
 
-def path_to_token(token):
-    """Extract the path from the ROOT to a specific token.
-    
     Parameters
     ----------
-    token : spacy.tokens.token.Token
-    
+    text : str
+
+    Returns
+    -------
+    spacy.tokens.doc.Doc
+    """
+
+    return nlp(text)
+
+
+def get_doc(sentence):
+    """Get the Doc object of spaCy corresponding to the sentence.
+
+    If the sentence is already a parsed Doc object it is returned as it is,
+    otherwise it is parsed by the spaCy pipeline.
+
+    Parameters
+    ----------
+    sentence : str or spacy.tokens.doc.Doc
+
+    Returns
+    -------
+    spacy.tokens.doc.Doc
+        The parsed sentence
+    """
+
+    if isinstance(sentence, Doc):
+        return sentence
+
+    return _parse(sentence)
+
+def _roots(doc):
+    """Get the indices of the ROOT tokens of the doc, caching them.
+
+    The doc is scanned only on the first call: the indices are stored in
+    Doc.user_data, so the functions running on the same doc afterwards
+    reuse them without scanning again.
+
+    Parameters
+    ----------
+    doc : spacy.tokens.doc.Doc
+
     Returns
     -------
     list
-        The list of dependency relations from the ROOT to the token
+        The indices of the ROOT tokens, one per sentence of the doc
     """
 
-    path = list()
-    while token.head != token:
-        path.append(token.dep_)
-        token = token.head
+    roots = doc.user_data.get("_roots")
+    if roots is None:
+        roots = [token.i for token in doc if token.head == token]
+        doc.user_data["_roots"] = roots
 
-    path.append(token.dep_)
-    return path[::-1]
+    return roots
 
 
 def extract_path(sentence):
-    """Extract for each token a path of dependency relations from the ROOT to the token.    
+    """Extract for each token a path of dependency relations from the ROOT to the token.
 
     Parse the sentence to get a Doc object of spaCy.
-    For each token find the path of dependency relations from the ROOT to the token.
+    Visit the dependency tree depth-first starting from the ROOT: the path of
+    each token is the path of its head extended with its dependency relation,
+    so every path is computed in a single traversal of the tree.
 
     Parameters
     ----------
-    sentence : str
-        The sentence to be parsed and tokenized
-    
+    sentence : str or spacy.tokens.doc.Doc
+        The sentence to be parsed and tokenized, or an already parsed Doc
+
     Returns
     -------
     dict
         A dict of lists of dependency relations with the tokens of the sentence as keys
     """
 
-    # TODO: can be a DFS search
-    doc = nlp(sentence)
-    paths = dict()
-
-    for token in doc:
-        paths[token] = path_to_token(token)
-
-    return paths
+    doc = get_doc(sentence)
+    n = len(doc)
+    if n == 0:
+        return dict()
+
+    # pull heads and dependency relations out of the doc in one shot: the
+    # DFS then runs on plain ints and strings, without creating a Token
+    # wrapper and going through its attributes at every step
+    arr = doc.to_array([HEAD, DEP])
+    # HEAD is the offset to the head stored as unsigned: cast it back to
+    # signed to recover the negative offsets
+    heads = np.arange(n) + arr[:, 0].astype(np.int64)
+    deps = [doc.vocab.strings[int(d)] for d in arr[:, 1]]
+
+    children = [[] for _ in range(n)]
+    roots = []
+    for i in range(n):
+        h = int(heads[i])
+        if h == i: # ROOT
+            roots.append(i)
+        else:
+            children[h].append(i)
+
+    # indexing a preallocated list by token.i avoids hashing a Token per
+    # insert; the Token-keyed dict is built only once at the end
+    paths = [None]*n
+
+    # DFS from the ROOT of each sentence of the doc: tuples share the
+    # common prefix of the path with the head of the token
+    stack = [(i, (deps[i],)) for i in roots]
+    while stack:
+        i, path = stack.pop()
+        paths[i] = list(path)
+        for c in children[i]:
+            stack.append((c, path + (deps[c],)))
+
+    return dict(zip(doc, paths))
 
 def extract_subtree(sentence):
-    """Extract the subtree of each token in the sentence. 
+    """Extract the subtree of each token in the sentence.
 
     Parse the sentence to get a Doc object of spaCy.
-    For each token find its subtree.
+    The subtree of a token is the contiguous span of the doc between its
+    left edge and its right edge, so it is returned as a zero-copy Span
+    view instead of materializing a list of tokens.
 
     Parameters
     ----------
-    sentence : str
-        The sentence to be parsed and tokenized
-    
+    sentence : str or spacy.tokens.doc.Doc
+        The sentence to be parsed and tokenized, or an already parsed Doc
+
     Returns
     -------
     dict
-        A dict of lists of tokens representing the subtree with the tokens of the sentence as keys
+        A dict of spans representing the subtree with the tokens of the sentence as keys
     """
 
-    doc = nlp(sentence)
-    subtrees = dict()
+    doc = get_doc(sentence)
+    subtrees = [doc[token.left_edge.i:token.right_edge.i+1] for token in doc]
+
+    return dict(zip(doc, subtrees))
+
+@lru_cache(maxsize=256)
+def _subtree_matcher(words):
+    """Get a PhraseMatcher matching the given tuple of words, caching it.
+
+    Compiling the pattern hashes every word: caching the matcher hoists
+    this work out of repeated `check_subtree` calls with the same words.
+
+    Parameters
+    ----------
+    words : tuple
+        A tuple of strings representing the list of tokens
+
+    Returns
+    -------
+    spacy.matcher.PhraseMatcher
+    """
 
-    for token in doc:
-        subtrees[token] = list(token.subtree)
+    matcher = PhraseMatcher(nlp.vocab, attr="ORTH")
+    # building the pattern Doc directly from the words avoids re-tokenizing
+    matcher.add("subtree", [Doc(nlp.vocab, words=list(words))])
+    return matcher
 
-    return subtrees
 
 def check_subtree(sentence, words):
     """Check if the given list of words forms a subtree in the dependency graph of the sentence.
 
+    The occurrences of the words in the doc are found by a PhraseMatcher,
+    whose matching loop runs in Cython: a hit is a subtree if its span
+    coincides with the span between the left edge and the right edge of
+    its root (subtrees are contiguous spans of the sentence).
+
     Parameters
     ----------
-    sentence : str
-        The sentence to be parsed and tokenized
+    sentence : str or spacy.tokens.doc.Doc
+        The sentence to be parsed and tokenized, or an already parsed Doc
     words : list
         A list of strings representing the list of tokens
-    
+
     Returns
     -------
     bool
     """
 
-    subtrees = extract_subtree(sentence)
+    if len(words) == 0: # no subtree is empty
+        return False
 
-    for st in subtrees.values():
-        if len(st) != len(words):
-            continue
+    doc = get_doc(sentence)
+    matcher = _subtree_matcher(tuple(words))
 
-        subtree_found = True
-        for token, word in zip(st, words):
-            if token.text != word:
-                subtree_found = False
-                break
-        
-        if subtree_found:
+    for _, start, end in matcher(doc):
+        root = doc[start:end].root
+        if root.left_edge.i == start and root.right_edge.i == end - 1:
             return True
-    
+
     return False
     
 
@@ -113,25 +231,26 @@ def get_head(span):
     """Get the head of the span.
 
     Parse the span to get a Doc object of spaCy.
-    Find the head of the span.
+    The head is the ROOT of the span, whose index is cached on the doc so
+    repeated calls on the same doc do not scan the tokens again.
 
     Parameters
     ----------
-    span : str
-        The span to be parsed and tokenized
-    
+    span : str or spacy.tokens.doc.Doc
+        The span to be parsed and tokenized, or an already parsed Doc
+
     Returns
     -------
     spacy.tokens.token.Token
         The head of the span
     """
 
-    doc = nlp(span)
-    for token in doc:
-        if token.head == token:
-            return token
-    
-    return None # error
+    doc = get_doc(span)
+    roots = _roots(doc)
+    if len(roots) == 0:
+        return None # error
+
+    return doc[roots[0]]
 
 
 def extract_nsubj_dobj_iobj(sentence):
@@ -139,31 +258,79 @@ def extract_nsubj_dobj_iobj(sentence):
 
     Parameters
     ----------
-    sentence : str
-        The sentence to be parsed and tokenized
-    
+    sentence : str or spacy.tokens.doc.Doc
+        The sentence to be parsed and tokenized, or an already parsed Doc
+
     Returns
     -------
     dict
         A dictionary containing for each key (subject, direct object and indirect object) a list of spans.
-        If for example there are more subjects in the sentence, the entry "nsubj" will be a list containing 
+        If for example there are more subjects in the sentence, the entry "nsubj" will be a list containing
         all the subject spans.
     """
 
-    doc = nlp(sentence)
+    doc = get_doc(sentence)
     spans = {"nsubj":[], "dobj":[], "iobj":[]}
-    
-    for token in doc:
-        if token.dep == nsubj:
-            spans["nsubj"].append(list(token.subtree))
-        if token.dep == dobj:
-            spans["dobj"].append(list(token.subtree))
-        if token.dep == iobj or token.dep_ == "dative": # depends on spaCy version
-            spans["iobj"].append(list(token.subtree))
+
+    # locate the tokens of interest with a vectorized scan of the dependency
+    # labels instead of testing every token in Python
+    deps = doc.to_array([DEP])
+    targets = np.fromiter(SPAN_KEYS.keys(), dtype=deps.dtype, count=len(SPAN_KEYS))
+    for i in np.flatnonzero(np.isin(deps, targets)):
+        token = doc[int(i)]
+        # the subtree is the contiguous span between the edges of the token:
+        # a Span is a zero-copy view, no Token list is materialized
+        subtree = doc[token.left_edge.i:token.right_edge.i+1]
+        spans[SPAN_KEYS[int(deps[i])]].append(subtree)
 
     return spans
 
-    
+
+def analyze(sentence):
+    """Extract paths, subtrees and nsubj/dobj/iobj spans in a single pass.
+
+    Perform one depth-first visit of the dependency tree computing at the
+    same time the results of `extract_path`, `extract_subtree` and
+    `extract_nsubj_dobj_iobj`: the path of each token is obtained extending
+    the path of its head, while the subtree of each token is the zero-copy
+    Span between its left edge and its right edge.
+
+    Parameters
+    ----------
+    sentence : str or spacy.tokens.doc.Doc
+        The sentence to be parsed and tokenized, or an already parsed Doc
+
+    Returns
+    -------
+    tuple
+        A tuple (paths, subtrees, spans) with the same content returned by
+        `extract_path`, `extract_subtree` and `extract_nsubj_dobj_iobj`
+    """
+
+    doc = get_doc(sentence)
+    paths = [None]*len(doc)
+    subtrees = [None]*len(doc)
+    spans = {"nsubj":[], "dobj":[], "iobj":[]}
+
+    def visit(token, path):
+        path = path + (token.dep_,)
+        paths[token.i] = list(path)
+
+        subtree = doc[token.left_edge.i:token.right_edge.i+1]
+        subtrees[token.i] = subtree
+
+        key = SPAN_KEYS.get(token.dep)
+        if key is not None:
+            spans[key].append(subtree)
+
+        for child in token.children:
+            visit(child, path)
+
+    for i in _roots(doc):
+        visit(doc[i], tuple())
+
+    return dict(zip(doc, paths)), dict(zip(doc, subtrees)), spans
+
 
 if __name__ == "__main__":
     # testing of the implemented functions
@@ -191,12 +358,21 @@ if __name__ == "__main__":
         "I read her the letter."
     ]
 
-    for sentence in test_sentences:
+    import os
+
+    # parse all the sentences in a single batch: every sentence is parsed
+    # only once and the parsed Doc is shared among the functions; with more
+    # than one core available the batch is fanned out across processes
+    n_process = max(1, (os.cpu_count() or 1) - 1)
+    docs = list(nlp.pipe(test_sentences, batch_size=16, n_process=n_process))
+
+    for sentence, doc in zip(test_sentences, docs):
         print("\n"+"-"*150)
         print(sentence)
         print("-"*150)
 
-        print("PATHS TO TOKENS: ", extract_path(sentence))
-        print("SUBTREES: ", extract_subtree(sentence))
-        print("HEAD: ", get_head(sentence))
-        print(extract_nsubj_dobj_iobj(sentence))
+        paths, subtrees, spans = analyze(doc)
+        print("PATHS TO TOKENS: ", paths)
+        print("SUBTREES: ", subtrees)
+        print("HEAD: ", get_head(doc))
+        print(spans)